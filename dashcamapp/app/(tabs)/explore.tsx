@@ -7,6 +7,11 @@ import * as Location from "expo-location"
 import axios from "axios"
 import { Ionicons } from "@expo/vector-icons"
 
+// Identifies this app session to the server's per-device upload scheduling
+const DEVICE_ID = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms))
+
 export default function HomeScreen() {
   const [hasCameraPermission, setHasCameraPermission] = useState<boolean | null>(null)
   const [hasLocationPermission, setHasLocationPermission] = useState<boolean | null>(null)
@@ -81,14 +86,25 @@ export default function HomeScreen() {
     isUploading.current = true
 
     while (videoQueue.length > 0) {
-      const { videoUri, startTime, startLocation, endLocation } = videoQueue.shift() // Remove from queue
+      const clip = videoQueue.shift() // Remove from queue
+      const { videoUri, startTime, startLocation, endLocation } = clip
 
       uploadCount.current += 1; // Increment count
       try {
         await uploadVideoWithLocation(videoUri, startTime, startLocation, endLocation)
         setMessage(`Uploaded video #${uploadCount.current} from queue`)
       } catch (error) {
-        setMessage(`Upload failed: ${error.message}`)
+        const status = error.response?.status
+        if (status === 429 || status === 503) {
+          // Server is busy: put the clip back and wait as long as it asks
+          videoQueue.unshift(clip)
+          uploadCount.current -= 1
+          const retryAfter = Number(error.response.headers["retry-after"]) || 5
+          setMessage(`Server busy, retrying in ${retryAfter}s`)
+          await sleep(retryAfter * 1000)
+        } else {
+          setMessage(`Upload failed: ${error.message}`)
+        }
       }
     }
     isUploading.current = false
@@ -111,13 +127,14 @@ export default function HomeScreen() {
       formData.append("startTime", startTime.toString())
 
       const response = await axios.post("https://jeganz-yolo-flask-api.hf.space/upload", formData, {
-        headers: { "Content-Type": "multipart/form-data" },
+        headers: { "Content-Type": "multipart/form-data", "X-Device-Id": DEVICE_ID },
       })
       console.log(response.data);
 
       setMessage("Upload successful!")
     } catch (error) {
       setMessage(`Upload failed: ${error.message}`)
+      throw error // Let the queue decide whether to retry
     }
   }
 
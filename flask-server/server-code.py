@@ -2,21 +2,32 @@ import os
 # Redirect Torch Hub cache directory to a writable location
 os.environ["TORCH_HOME"] = "/tmp/torch"
 
-from flask import Flask, request, jsonify,render_template
+from flask import Flask, Response, request, jsonify,render_template
 import numpy as np
 import cv2
 import torch
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from ultralytics import YOLO
 import json
 from datetime import datetime
 import psycopg2
 import uuid  # For generating unique filenames
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+import struct
+import zlib
+from collections import OrderedDict, deque
 
 
 os.environ["PYTHONUNBUFFERED"] = "1"
 app = Flask(__name__)
-CORS(app)
+# Behind the Spaces proxy; take the client address from X-Forwarded-For
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get("TRUSTED_PROXIES", 1)))
+CORS(app, expose_headers=["X-Record-Format"])  # Lets the map page read the packed /potholes layout
 
 # Database credentials
 db_config = {
@@ -31,25 +42,114 @@ db_config = {
 # Load YOLO model
 model = YOLO('best.pt')  # Replace with your actual model
 
-#Load MiDas model
+#Load MiDas model, pinned to a release so depth maps (and cached severities) stay stable
+MIDAS_REPO = "intel-isl/MiDaS:v3_1"
 print("Loading MiDaS model...")
-midas = torch.hub.load("intel-isl/MiDaS", "DPT_Large", trust_repo=True)
+midas = torch.hub.load(MIDAS_REPO, "DPT_Large", trust_repo=True)
 midas.eval()
 
 print("Loading MiDaS transforms...")
-transform = torch.hub.load("intel-isl/MiDaS", "transforms", trust_repo=True).default_transform
+transform = torch.hub.load(MIDAS_REPO, "transforms", trust_repo=True).default_transform
 
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)  # Ensure the folder exists
 
-def detect_objects_with_yolo(frame):
+# Multi-resolution inference: YOLO runs on a downscaled copy of the frame,
+# MiDaS crops are still cut from the original resolution.
+DETECT_IMGSZ = int(os.environ.get("DETECT_IMGSZ", 640))  # Longest side used for detection
+# Region of interest as fractions of frame height; rows outside it (sky,
+# dashboard) are blanked before detection.
+ROI_TOP = float(os.environ.get("ROI_TOP", 0.0))
+ROI_BOTTOM = float(os.environ.get("ROI_BOTTOM", 1.0))
+if not 0 <= ROI_TOP < ROI_BOTTOM <= 1:
+    # A wrong ROI would mask every frame and delete every pothole
+    raise ValueError(f"Need 0 <= ROI_TOP < ROI_BOTTOM <= 1, got ROI_TOP={ROI_TOP}, ROI_BOTTOM={ROI_BOTTOM}")
+BOX_PADDING = 30  # Pixels added around each box before depth estimation
+
+# Result cache: upload content hash + model version -> frame severities, so
+# retried or duplicate clips are answered without reprocessing.
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "result_cache.sqlite3")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Bump whenever severity scoring changes (calculate_pothole_severity,
+# calculate_frame_severity, BOX_PADDING, ...) so cached results are not reused
+SCORING_VERSION = "1"
+
+def compute_model_version(weights_path='best.pt'):
+    """Identify the weights, depth model and scoring settings that produced a cached result."""
+    sha = hashlib.sha256()
+    with open(weights_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return f"{sha.hexdigest()[:16]}-{MIDAS_REPO}-{SCORING_VERSION}-{BOX_PADDING}-{DETECT_IMGSZ}-{ROI_TOP}-{ROI_BOTTOM}"
+
+MODEL_VERSION = compute_model_version()
+
+# content hash -> UploadJob still queued or running, so retries wait on it
+in_flight_uploads = {}
+in_flight_lock = threading.Lock()
+
+# Upload scheduling: one worker processes clips, fresh clips and clips from
+# unmapped areas first, round-robin across devices within a priority.
+MAX_BACKLOG = int(os.environ.get("MAX_BACKLOG", 32))  # Queued clips before shedding load
+DEVICE_UPLOADS_PER_MINUTE = float(os.environ.get("DEVICE_UPLOADS_PER_MINUTE", 30))
+DEVICE_UPLOAD_BURST = int(os.environ.get("DEVICE_UPLOAD_BURST", 10))
+FRESH_CLIP_SECONDS = 10 * 60  # Clips recorded more recently than this count as fresh
+MAPPED_AREA_RADIUS = 0.0005  # Degrees (~50 m) searched for existing potholes
+PRIORITY_AGING_SECONDS = 60  # Waiting this long raises a clip by one priority level
+UPLOAD_WAIT_TIMEOUT = 300  # Seconds a request waits for its clip before answering 503
+
+# /potholes export: rows are streamed from a server-side cursor in batches
+POTHOLE_EXPORT_BATCH = 2000
+POTHOLE_JSON = "application/json"
+POTHOLE_COLUMNAR = "application/vnd.potholes.columnar+ndjson"  # One object of parallel arrays per batch
+POTHOLE_PACKED = "application/vnd.potholes.packed"  # Fixed-size little-endian records
+POTHOLE_FORMATS = {"json": POTHOLE_JSON, "columnar": POTHOLE_COLUMNAR, "packed": POTHOLE_PACKED}
+# id (uint64), longitude, latitude, severity (one unsigned byte; scores are 1-5,
+# 0 if unknown), timestamp (epoch seconds, NaN if unknown)
+POTHOLE_RECORD = struct.Struct("<QddBd")
+
+# Severity history: every detection is appended to pothole_observations and
+# rolled up per pothole and per grid cell as it is written.
+GRID_CELL_SIZE = 0.001  # Degrees (~110 m) per summary cell side
+TREND_ALPHA = 0.3  # Weight of the newest observation in recent_severity
+
+def detect_objects_with_yolo(frame, imgsz=None):
     """Run YOLO detection on a frame."""
     try:
-        results = model.predict(source=frame, conf=0.3, show=False)
+        results = model.predict(source=frame, conf=0.3, show=False, imgsz=imgsz or 640)
         return results[0] if results else None
     except Exception:
         return None
 
+def detect_potholes_multires(frame):
+    """Detect on a downscaled, ROI-masked frame and return boxes in original frame coordinates."""
+    height, width = frame.shape[:2]
+    scale = min(1.0, DETECT_IMGSZ / max(height, width))
+    if scale < 1.0:
+        small = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    else:
+        small = frame.copy()
+
+    small_height = small.shape[0]
+    roi_top, roi_bottom = int(small_height * ROI_TOP), int(small_height * ROI_BOTTOM)
+    small[:roi_top] = 0
+    small[roi_bottom:] = 0
+
+    result = detect_objects_with_yolo(small, imgsz=DETECT_IMGSZ)
+    if result is None:
+        return []
+
+    boxes = []
+    for box in result.boxes:
+        x1, y1, x2, y2 = box.xyxy[0].cpu().numpy() / scale
+        # Drop boxes whose centre falls in the masked rows
+        centre_y = (y1 + y2) / 2
+        if centre_y < height * ROI_TOP or centre_y > height * ROI_BOTTOM:
+            continue
+        boxes.append((int(x1), int(y1), int(x2), int(y2)))
+    return boxes
+
 def calculate_pothole_severity(d_max, d_min, area, avg_depth, max_area=80000):
         """Calculates severity score (1 to 5) for an individual pothole."""
         D = (d_max - d_min) / (60 - 10) 
@@ -94,25 +194,219 @@ def estimate_depth(region):
     area = region.shape[0] * region.shape[1]
     pothole_severity = calculate_pothole_severity(d_max, d_min, area, avg_depth)
     return pothole_severity
+
+def calculate_frame_severity_score(frame):
+    """Returns the rounded frame severity (1 to 5), or None if no pothole is detected."""
+    boxes = detect_potholes_multires(frame)
+    if not boxes:
+        return None
+
+    height, width = frame.shape[:2]
+    pothole_severities = []
+    for x1, y1, x2, y2 in boxes:
+        x1, y1 = max(0, x1 - BOX_PADDING), max(0, y1 - BOX_PADDING)
+        x2, y2 = min(width, x2 + BOX_PADDING), min(height, y2 + BOX_PADDING)
+        region = frame[y1:y2, x1:x2]
+
+        if region.size > 0:
+            pothole_severities.append(estimate_depth(region))
+
+    frame_severity = calculate_frame_severity(pothole_severities, len(boxes))
+    return int(np.round(frame_severity))
     
+history_schema_ready = False
+history_schema_lock = threading.Lock()
+
+
+def create_history_schema(cursor):
+    """Create the observation and summary tables, backfilling them from potholes the first time."""
+    cursor.execute('''SELECT to_regclass('pothole_summaries')''')
+    first_time = cursor.fetchone()[0] is None
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS pothole_observations (
+                        id BIGSERIAL PRIMARY KEY,
+                        latitude DOUBLE PRECISION NOT NULL,
+                        longitude DOUBLE PRECISION NOT NULL,
+                        severity INTEGER NOT NULL,
+                        is_repair BOOLEAN NOT NULL DEFAULT false,
+                        observed_at TIMESTAMPTZ NOT NULL DEFAULT now())''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS pothole_observations_location
+                        ON pothole_observations (latitude, longitude, observed_at)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS pothole_summaries (
+                        latitude DOUBLE PRECISION,
+                        longitude DOUBLE PRECISION,
+                        observation_count INTEGER NOT NULL,
+                        severity_sum BIGINT NOT NULL,
+                        max_severity INTEGER NOT NULL,
+                        last_severity INTEGER NOT NULL,
+                        recent_severity DOUBLE PRECISION NOT NULL,
+                        first_seen TIMESTAMPTZ NOT NULL,
+                        last_seen TIMESTAMPTZ NOT NULL,
+                        repaired_at TIMESTAMPTZ,
+                        PRIMARY KEY (latitude, longitude))''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS grid_cell_summaries (
+                        cell_lat INTEGER,
+                        cell_lon INTEGER,
+                        observation_count INTEGER NOT NULL,
+                        severity_sum BIGINT NOT NULL,
+                        max_severity INTEGER NOT NULL,
+                        last_severity INTEGER NOT NULL,
+                        recent_severity DOUBLE PRECISION NOT NULL,
+                        first_seen TIMESTAMPTZ NOT NULL,
+                        last_seen TIMESTAMPTZ NOT NULL,
+                        open_potholes INTEGER NOT NULL,
+                        repair_count INTEGER NOT NULL DEFAULT 0,
+                        last_repaired_at TIMESTAMPTZ,
+                        PRIMARY KEY (cell_lat, cell_lon))''')
+    if not first_time:
+        return
+
+    # Seed the history with the potholes already on the map
+    cursor.execute('''INSERT INTO pothole_observations (latitude, longitude, severity, observed_at)
+                        SELECT latitude, longitude, severity, COALESCE("timestamp", now())
+                        FROM potholes WHERE severity IS NOT NULL''')
+    cursor.execute('''INSERT INTO pothole_summaries (latitude, longitude, observation_count, severity_sum, max_severity,
+                                                    last_severity, recent_severity, first_seen, last_seen)
+                        SELECT DISTINCT ON (latitude, longitude) latitude, longitude, 1, severity, severity,
+                               severity, severity, COALESCE("timestamp", now()), COALESCE("timestamp", now())
+                        FROM potholes WHERE severity IS NOT NULL
+                        ORDER BY latitude, longitude, "timestamp" DESC NULLS LAST''')
+    cursor.execute('''INSERT INTO grid_cell_summaries (cell_lat, cell_lon, observation_count, severity_sum, max_severity,
+                                                      last_severity, recent_severity, first_seen, last_seen, open_potholes)
+                        SELECT floor(latitude::double precision / %s)::integer, floor(longitude::double precision / %s)::integer,
+                               count(*), sum(severity), max(severity),
+                               (array_agg(severity ORDER BY "timestamp" DESC NULLS LAST))[1], avg(severity),
+                               COALESCE(min("timestamp"), now()), COALESCE(max("timestamp"), now()), count(*)
+                        FROM potholes WHERE severity IS NOT NULL
+                        GROUP BY 1, 2''', (GRID_CELL_SIZE, GRID_CELL_SIZE))
+
+
+def grid_cell(latitude, longitude):
+    return math.floor(latitude / GRID_CELL_SIZE), math.floor(longitude / GRID_CELL_SIZE)
+
+
+def record_observation(cursor, latitude, longitude, severity, new_pothole):
+    """Append a detection to the history and roll it into the pothole and grid cell summaries."""
+    cursor.execute('''INSERT INTO pothole_observations (latitude, longitude, severity) VALUES (%s, %s, %s)''',
+                   (latitude, longitude, severity))
+    cursor.execute('''INSERT INTO pothole_summaries AS s (latitude, longitude, observation_count, severity_sum, max_severity,
+                                                          last_severity, recent_severity, first_seen, last_seen)
+                        VALUES (%s, %s, 1, %s, %s, %s, %s, now(), now())
+                        ON CONFLICT (latitude, longitude) DO UPDATE SET
+                            observation_count = s.observation_count + 1,
+                            severity_sum = s.severity_sum + EXCLUDED.severity_sum,
+                            max_severity = GREATEST(s.max_severity, EXCLUDED.max_severity),
+                            last_severity = EXCLUDED.last_severity,
+                            recent_severity = s.recent_severity + %s * (EXCLUDED.last_severity - s.recent_severity),
+                            last_seen = EXCLUDED.last_seen,
+                            repaired_at = NULL''',
+                   (latitude, longitude, severity, severity, severity, severity, TREND_ALPHA))
+    update_grid_cell(cursor, latitude, longitude, severity, 1 if new_pothole else 0)
+
+
+def record_repair(cursor, latitude, longitude):
+    """Record that a pothole is gone.
+
+    The pothole's summary is kept and marked repaired. Repairs are counted
+    apart from detections so they never skew count, mean or max, but they
+    pull the cell's recent severity (and so its trend) towards zero.
+    """
+    cursor.execute('''INSERT INTO pothole_observations (latitude, longitude, severity, is_repair) VALUES (%s, %s, 0, true)''',
+                   (latitude, longitude))
+    cursor.execute('''UPDATE pothole_summaries SET repaired_at = now() WHERE latitude = %s AND longitude = %s''',
+                   (latitude, longitude))
+    cell_lat, cell_lon = grid_cell(latitude, longitude)
+    cursor.execute('''UPDATE grid_cell_summaries SET
+                            repair_count = repair_count + 1,
+                            last_repaired_at = now(),
+                            open_potholes = GREATEST(open_potholes - 1, 0),
+                            recent_severity = recent_severity * (1 - %s)
+                        WHERE cell_lat = %s AND cell_lon = %s''',
+                   (TREND_ALPHA, cell_lat, cell_lon))
+
+
+def update_grid_cell(cursor, latitude, longitude, severity, open_delta):
+    """Roll a detection into its grid cell; open_delta is 1 for a newly mapped pothole."""
+    cell_lat, cell_lon = grid_cell(latitude, longitude)
+    cursor.execute('''INSERT INTO grid_cell_summaries AS s (cell_lat, cell_lon, observation_count, severity_sum, max_severity,
+                                                            last_severity, recent_severity, first_seen, last_seen, open_potholes)
+                        VALUES (%s, %s, 1, %s, %s, %s, %s, now(), now(), %s)
+                        ON CONFLICT (cell_lat, cell_lon) DO UPDATE SET
+                            observation_count = s.observation_count + 1,
+                            severity_sum = s.severity_sum + EXCLUDED.severity_sum,
+                            max_severity = GREATEST(s.max_severity, EXCLUDED.max_severity),
+                            last_severity = EXCLUDED.last_severity,
+                            recent_severity = s.recent_severity + %s * (EXCLUDED.last_severity - s.recent_severity),
+                            last_seen = EXCLUDED.last_seen,
+                            open_potholes = s.open_potholes + %s''',
+                   (cell_lat, cell_lon, severity, severity, severity, severity, open_delta, TREND_ALPHA, open_delta))
+
+
+def ensure_history_schema():
+    """Create (and backfill) the history tables in their own transaction; returns whether they are ready.
+
+    Must run before the potholes write it accompanies, otherwise the backfill
+    would already include that write and it would be counted twice.
+    """
+    global history_schema_ready
+    with history_schema_lock:
+        if history_schema_ready:
+            return True
+        conn = None
+        try:
+            conn = psycopg2.connect(**db_config)
+            cursor = conn.cursor()
+            create_history_schema(cursor)
+            conn.commit()
+            history_schema_ready = True
+
+        except Exception as e:
+            print(f"Error creating history tables: {e}")
+
+        finally:
+            if conn:
+                cursor.close()
+                conn.close()
+        return history_schema_ready
+
+
+def record_history(cursor, record, *args):
+    """Run a history write inside a savepoint so a failure never rolls back the potholes change."""
+    global history_schema_ready
+    cursor.execute('''SAVEPOINT history''')
+    try:
+        record(cursor, *args)
+        cursor.execute('''RELEASE SAVEPOINT history''')
+    except Exception as e:
+        # Retry creating the tables on the next write
+        history_schema_ready = False
+        cursor.execute('''ROLLBACK TO SAVEPOINT history''')
+        print(f"Error recording pothole history: {e}")
+
+
 def insert_or_update_location_in_db(latitude, longitude, severity):
     if latitude is None or longitude is None:
         return
+    history_ready = ensure_history_schema()
     try:
         conn = psycopg2.connect(**db_config)
         cursor = conn.cursor()
         
         # Check if the location already exists
         cursor.execute('''SELECT severity FROM potholes WHERE latitude = %s AND longitude = %s''', (latitude, longitude))
+        exists = cursor.fetchone() is not None
 
-        if cursor.fetchone():
+        if exists:
             # Update severity if location already exists
             cursor.execute('''UPDATE potholes SET severity = %s WHERE latitude = %s AND longitude = %s''', (severity, latitude, longitude))
             
         else:
             # Insert new record if location is not in DB
             cursor.execute('''INSERT INTO potholes (latitude, longitude, severity) VALUES (%s, %s, %s)''', (latitude, longitude, severity))
-        
+
+        # Keep the history alongside the current severity, in the same transaction
+        if history_ready:
+            record_history(cursor, record_observation, latitude, longitude, severity, not exists)
         conn.commit()
         
     except Exception as e:
@@ -124,7 +418,84 @@ def insert_or_update_location_in_db(latitude, longitude, severity):
             conn.close()
 
 
+def open_result_cache():
+    conn = sqlite3.connect(RESULT_CACHE_PATH, timeout=10)
+    conn.execute('''CREATE TABLE IF NOT EXISTS results (
+                        content_hash TEXT NOT NULL,
+                        model_version TEXT NOT NULL,
+                        results TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        last_access REAL NOT NULL,
+                        PRIMARY KEY (content_hash, model_version))''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)''')
+    return conn
+
+
+def get_cached_results(content_hash):
+    """Return cached results for an upload, or None on a miss."""
+    conn = None
+    try:
+        conn = open_result_cache()
+        row = conn.execute('''SELECT results FROM results WHERE content_hash = ? AND model_version = ?''',
+                           (content_hash, MODEL_VERSION)).fetchone()
+        if row is None:
+            return None
+        conn.execute('''UPDATE results SET last_access = ? WHERE content_hash = ? AND model_version = ?''',
+                     (time.time(), content_hash, MODEL_VERSION))
+        conn.commit()
+        return json.loads(row[0])
+
+    except Exception as e:
+        print(f"Error reading result cache: {e}")
+        return None
+
+    finally:
+        if conn:
+            conn.close()
+
+
+def store_cached_results(content_hash, results):
+    """Cache results for an upload and evict least recently used entries over the size limit."""
+    conn = None
+    try:
+        conn = open_result_cache()
+        payload = json.dumps(results)
+        conn.execute('''INSERT OR REPLACE INTO results (content_hash, model_version, results, size, last_access)
+                        VALUES (?, ?, ?, ?, ?)''',
+                     (content_hash, MODEL_VERSION, payload, len(payload), time.time()))
+
+        total_size = conn.execute('''SELECT COALESCE(SUM(size), 0) FROM results''').fetchone()[0]
+        if total_size > RESULT_CACHE_MAX_BYTES:
+            rows = conn.execute('''SELECT content_hash, model_version, size FROM results ORDER BY last_access''')
+            evicted = []
+            for row_hash, row_version, size in rows:
+                if total_size <= RESULT_CACHE_MAX_BYTES:
+                    break
+                evicted.append((row_hash, row_version))
+                total_size -= size
+            conn.executemany('''DELETE FROM results WHERE content_hash = ? AND model_version = ?''', evicted)
+        conn.commit()
+
+    except Exception as e:
+        print(f"Error writing result cache: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+
+def save_upload(file, filepath):
+    """Stream an uploaded file to disk and return the SHA-256 of its contents."""
+    sha = hashlib.sha256()
+    with open(filepath, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+            sha.update(chunk)
+            out.write(chunk)
+    return sha.hexdigest()
+
+
 def delete_location_from_db(latitude, longitude):
+    history_ready = ensure_history_schema()
     try:
         conn = psycopg2.connect(**db_config)
         cursor = conn.cursor()
@@ -136,6 +507,8 @@ def delete_location_from_db(latitude, longitude):
             return
         
         cursor.execute('''DELETE FROM potholes WHERE latitude = %s AND longitude = %s''', (latitude, longitude))
+        if history_ready:
+            record_history(cursor, record_repair, latitude, longitude)
         conn.commit()
         print(f"Deleted location ({latitude}, {longitude}) from DB.")
     
@@ -148,10 +521,238 @@ def delete_location_from_db(latitude, longitude):
             conn.close()
 
 
+def is_mapped_area(latitude, longitude):
+    """Check whether any pothole is already recorded near a location."""
+    conn = None
+    try:
+        conn = psycopg2.connect(**db_config)
+        cursor = conn.cursor()
+        cursor.execute('''SELECT 1 FROM potholes WHERE latitude BETWEEN %s AND %s AND longitude BETWEEN %s AND %s LIMIT 1''',
+                       (latitude - MAPPED_AREA_RADIUS, latitude + MAPPED_AREA_RADIUS,
+                        longitude - MAPPED_AREA_RADIUS, longitude + MAPPED_AREA_RADIUS))
+        return cursor.fetchone() is not None
+
+    except Exception as e:
+        # Treat as mapped so a DB hiccup does not bump the clip's priority
+        print(f"Error checking mapped area: {e}")
+        return True
+
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+
+def upload_priority(start_location, end_location):
+    """Returns the clip's priority (0 runs first): fresh before backlog, unmapped before mapped.
+
+    Missing or malformed locations get the lowest priority.
+    """
+    location = start_location or end_location
+    try:
+        timestamp = location.get('timestamp')
+        latitude = float(location['coords']['latitude'])
+        longitude = float(location['coords']['longitude'])
+        if timestamp is None:
+            fresh = True
+        else:
+            timestamp = float(timestamp)
+            if timestamp > 1e11:  # Milliseconds from the app
+                timestamp /= 1000
+            fresh = time.time() - timestamp <= FRESH_CLIP_SECONDS
+    except Exception:
+        return 3
+
+    mapped = is_mapped_area(latitude, longitude)
+    return (0 if fresh else 2) + (1 if mapped else 0)
+
+
+class UploadJob:
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.queued_at = time.monotonic()
+
+
+class UploadScheduler:
+    """Runs upload jobs on a single worker thread.
+
+    Lower priorities run first, but a priority class is raised one level for
+    every PRIORITY_AGING_SECONDS its oldest job has waited, so backlog clips
+    are never starved by fresh ones. Within a priority, devices are served
+    round-robin so one device's backlog cannot starve the others. Each device
+    is also rate limited with a token bucket, charged only for queued jobs.
+    Buckets are keyed by client address rather than the self-reported device
+    id, so a client cannot escape its limit by inventing new ids.
+    """
+
+    def __init__(self, max_backlog, uploads_per_minute, burst):
+        self.max_backlog = max_backlog
+        self.rate = uploads_per_minute / 60
+        self.burst = burst
+        self.queues = {}  # priority -> OrderedDict(device_id -> deque of jobs)
+        self.backlog = 0
+        self.buckets = {}  # device_id -> (tokens, last refill time)
+        self.avg_job_seconds = 5.0
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def refill_tokens(self, device_id, now):
+        tokens, last = self.buckets.get(device_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        self.buckets[device_id] = (tokens, now)
+        return tokens
+
+    def check_rate_limit(self, device_id):
+        """Returns 0 if the device may queue an upload, or seconds until it may."""
+        now = time.monotonic()
+        with self.condition:
+            tokens = self.refill_tokens(device_id, now)
+            if len(self.buckets) > 10000:
+                # Forget devices whose bucket has refilled completely
+                full_after = self.burst / self.rate
+                self.buckets = {d: b for d, b in self.buckets.items() if now - b[1] < full_after}
+            if tokens < 1:
+                return int(np.ceil((1 - tokens) / self.rate))
+            return 0
+
+    def retry_after(self):
+        """Estimated seconds until the current backlog drains."""
+        with self.condition:
+            return max(1, int(np.ceil(self.backlog * self.avg_job_seconds)))
+
+    def submit(self, device_id, rate_key, priority, func, *args):
+        """Queue a job under device_id and charge rate_key's bucket, or return None if the backlog is full."""
+        job = UploadJob(func, args)
+        with self.condition:
+            if self.backlog >= self.max_backlog:
+                return None
+            devices = self.queues.setdefault(priority, OrderedDict())
+            devices.setdefault(device_id, deque()).append(job)
+            self.backlog += 1
+            now = time.monotonic()
+            self.buckets[rate_key] = (self.refill_tokens(rate_key, now) - 1, now)
+            self.condition.notify()
+        return job
+
+    def next_job(self):
+        with self.condition:
+            while self.backlog == 0:
+                self.condition.wait()
+            now = time.monotonic()
+
+            def effective_priority(p):
+                oldest = min(jobs[0].queued_at for jobs in self.queues[p].values())
+                return p - (now - oldest) / PRIORITY_AGING_SECONDS
+
+            priority = min((p for p, devices in self.queues.items() if devices), key=effective_priority)
+            devices = self.queues[priority]
+            device_id, jobs = devices.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                devices[device_id] = jobs  # Back of the round-robin
+            self.backlog -= 1
+            return job
+
+    def run(self):
+        while True:
+            job = self.next_job()
+            started = time.monotonic()
+            try:
+                job.result = job.func(*job.args)
+            except Exception as e:
+                job.error = e
+            finally:
+                elapsed = time.monotonic() - started
+                with self.condition:
+                    self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+                job.done.set()
+
+
+scheduler = UploadScheduler(MAX_BACKLOG, DEVICE_UPLOADS_PER_MINUTE, DEVICE_UPLOAD_BURST)
+
+
+def process_upload(filepath, content_hash, start_location, end_location):
+    """Score the first and last frames of a saved clip and update the DB. Returns (body, status)."""
+    cap = cv2.VideoCapture(filepath)
+    if not cap.isOpened():
+        print('Failed to open video file', flush=True)
+        os.remove(filepath)
+        return {'message': 'Failed to open video file'}, 400
+
+    print("Cap oke open aan...polik", flush=True)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    print("Number of frames in video: ", total_frames, flush=True)
+    # Read first frame
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    success_first, first_frame = cap.read()
+    
+    # Read last frame
+    cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames - 1)
+    success_last, last_frame = cap.read()
+    
+    cap.release()
+    os.remove(filepath)
+    print("First and Last frame process cheyan pova", flush=True)
+    print(f'Success first {success_first} :: Sucess Last {success_last}')
+    results = {
+        'first_frame_severity': calculate_frame_severity_score(first_frame) if success_first else None,
+        'last_frame_severity': calculate_frame_severity_score(last_frame) if success_last else None,
+    }
+
+    if success_first and start_location:
+        print("First frame process cheyan pova", flush=True)
+        severity_score = results['first_frame_severity']
+        if severity_score is None:
+            print("Delete DB cheyyan pone aan (first frame)", flush=True)
+            delete_location_from_db(start_location['coords']['latitude'], start_location['coords']['longitude'])
+
+        else:
+            print("Insert DB cheyyan pone aan (first frame)", flush=True)
+            insert_or_update_location_in_db(start_location['coords']['latitude'], start_location['coords']['longitude'], severity_score)
+    
+    if success_last and end_location:
+        print("Last frame process cheyan pova", flush=True)
+        severity_score = results['last_frame_severity']
+        if severity_score is None:
+            print("Delete DB cheyyan pone aan (last frame)", flush=True)
+            delete_location_from_db(end_location['coords']['latitude'], end_location['coords']['longitude'])
+
+        else:
+            print("Insert DB cheyyan pone aan (last frame)", flush=True)
+            insert_or_update_location_in_db(end_location['coords']['latitude'], end_location['coords']['longitude'], severity_score)
+
+
+    store_cached_results(content_hash, results)
+
+    print("Video processed successfully", flush=True)
+    return {'message': 'Video processed successfully', 'cached': False, 'results': results}, 200
+
+
+def run_upload(filepath, content_hash, start_location, end_location):
+    try:
+        return process_upload(filepath, content_hash, start_location, end_location)
+    finally:
+        if os.path.exists(filepath):  # process_upload failed before removing it
+            os.remove(filepath)
+        # The result is cached by now, so later duplicates hit the cache instead
+        with in_flight_lock:
+            in_flight_uploads.pop(content_hash, None)
+
+
 @app.route('/upload', methods=['POST'])
 def process_video():
+    filepath = None
+    queued = False  # Once queued, the job owns filepath and removes it
     try:
         print("Processing video...", flush=True)
+        client_ip = request.remote_addr
+        # Round-robin slot; the rate limit is charged to client_ip
+        device_id = request.headers.get("X-Device-Id") or client_ip
+
         file = request.files.get("file")
         if not file:
             print('No file uploaded.', flush=True)
@@ -161,8 +762,15 @@ def process_video():
         print("File name ondakki uuid oke vach", flush=True)
         filepath = os.path.join(UPLOAD_FOLDER, filename)
         print("save cheyyan pova", flush=True)
-        file.save(filepath)
+        content_hash = save_upload(file, filepath)
         print("save cheyth success", flush=True)
+
+        cached = get_cached_results(content_hash)
+        if cached is not None:
+            # Retried or duplicate upload: the potholes were already written
+            print(f"Cache hit for {content_hash}", flush=True)
+            return jsonify({'message': 'Video processed successfully', 'cached': True, 'results': cached}), 200
+
         print(f'Ithaan makale request {request.form}')
         print('Start location and end location medikan pova', flush=True)
         start_loc = request.form.get("startLocation")
@@ -177,122 +785,278 @@ def process_video():
         except Exception as e:
             print("Location json eval cheythappo umfi: ",str(e), flush=True)
             start_location, end_location = None, None
-        
-        cap = cv2.VideoCapture(filepath)
-        if not cap.isOpened():
-            print('Failed to open video file', flush=True)
-            return jsonify({'message': 'Failed to open video file'}), 400
-
-        print("Cap oke open aan...polik", flush=True)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        print("Number of frames in video: ", total_frames, flush=True)
-        # Read first frame
-        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-        success_first, first_frame = cap.read()
-        
-        # Read last frame
-        cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames - 1)
-        success_last, last_frame = cap.read()
-        
-        cap.release()
-        os.remove(filepath)
-        print("First and Last frame process cheyan pova", flush=True)
-        print(f'Success first {success_first} :: Sucess Last {success_last}')
-        if success_first and start_location:
-            print("First frame process cheyan pova", flush=True)
-            result = detect_objects_with_yolo(first_frame)
-            if result is None or len(result.boxes) == 0:
-                print("Delete DB cheyyan pone aan (first frame)", flush=True)
-                delete_location_from_db(start_location['coords']['latitude'], start_location['coords']['longitude'])
-
-            else:
-                pothole_severities = []
-                num_potholes = len(result.boxes)
-                for box in result.boxes:
-                    x1, y1, x2, y2 = map(int, box.xyxy[0].cpu().numpy())
-                    x1, y1 = max(0, x1 - 30), max(0, y1 - 30)
-                    x2, y2 = min(first_frame.shape[1], x2 + 30), min(first_frame.shape[0], y2 + 30)
-                    region = first_frame[y1:y2, x1:x2]
-                    
-                    if region.size > 0:
-                        pothole_severity = estimate_depth(region)
-                        pothole_severities.append(pothole_severity)
-                
-                frame_severity = calculate_frame_severity(pothole_severities, num_potholes)
-                severity_score = int(np.round(frame_severity))
-                print("Insert DB cheyyan pone aan (first frame)", flush=True)
-                insert_or_update_location_in_db(start_location['coords']['latitude'], start_location['coords']['longitude'], severity_score)
-        
-        if success_last and end_location:
-            print("Last frame process cheyan pova", flush=True)
-            result = detect_objects_with_yolo(last_frame)
-            if result is None or len(result.boxes) == 0:
-                print("Delete DB cheyyan pone aan (last frame)", flush=True)
-                delete_location_from_db(end_location['coords']['latitude'], end_location['coords']['longitude'])
-
-            else:
-                pothole_severities = []
-                num_potholes = len(result.boxes)
-                for box in result.boxes:
-                    x1, y1, x2, y2 = map(int, box.xyxy[0].cpu().numpy())
-                    x1, y1 = max(0, x1 - 30), max(0, y1 - 30)
-                    x2, y2 = min(last_frame.shape[1], x2 + 30), min(last_frame.shape[0], y2 + 30)
-                    region = last_frame[y1:y2, x1:x2]
-                    
-                    if region.size > 0:
-                        pothole_severity = estimate_depth(region)
-                        pothole_severities.append(pothole_severity)
-                
-                frame_severity = calculate_frame_severity(pothole_severities, num_potholes)
-                severity_score = int(np.round(frame_severity))
-                print("Insert DB cheyyan pone aan (last frame)", flush=True)
-                insert_or_update_location_in_db(end_location['coords']['latitude'], end_location['coords']['longitude'], severity_score)
-
-
-        print("Video processed successfully", flush=True)
-        return jsonify({'message': 'Video processed successfully'}), 200
+
+        priority = upload_priority(start_location, end_location)
+        retry_after = 0
+        with in_flight_lock:
+            job = in_flight_uploads.get(content_hash)
+            duplicate = job is not None
+            if not duplicate:
+                # The first upload may have finished since the cache lookup above
+                cached = get_cached_results(content_hash)
+                if cached is None:
+                    # Only uploads that get queued count against the device's rate limit
+                    retry_after = scheduler.check_rate_limit(client_ip)
+                    if not retry_after:
+                        job = scheduler.submit(device_id, client_ip, priority, run_upload, filepath, content_hash, start_location, end_location)
+                        if job is not None:
+                            in_flight_uploads[content_hash] = job
+                            queued = True
+
+        if cached is not None:
+            print(f"Cache hit for {content_hash}", flush=True)
+            return jsonify({'message': 'Video processed successfully', 'cached': True, 'results': cached}), 200
+        if retry_after:
+            print(f'Rate limit hit for {client_ip}', flush=True)
+            return jsonify({'message': 'Too many uploads, retry later'}), 429, {'Retry-After': str(retry_after)}
+        if job is None:
+            # Shed only after the cache and in-flight lookups, so retries of known clips still get answered
+            print(f'Backlog full, shedding upload from {device_id}', flush=True)
+            return jsonify({'message': 'Server busy, retry later'}), 503, {'Retry-After': str(scheduler.retry_after())}
+
+        if duplicate:
+            print(f'Upload {content_hash} already in progress, waiting on it', flush=True)
+        else:
+            print(f'Queued upload from {device_id} with priority {priority}', flush=True)
+        if not job.done.wait(UPLOAD_WAIT_TIMEOUT):
+            # The job stays queued; a retry of the same clip waits on it or hits the cache
+            print(f'Timed out waiting for upload {content_hash}', flush=True)
+            return jsonify({'message': 'Still processing, retry later'}), 503, {'Retry-After': str(scheduler.retry_after())}
+        if job.error is not None:
+            raise job.error
+        body, status = job.result
+        if duplicate and status == 200:
+            body = {**body, 'cached': True}
+        return jsonify(body), status
         
     except Exception as e:
         print("An error occurred: ", str(e), flush=True)
         return jsonify({'message': 'An error occurred', 'error': str(e)}), 500
 
+    finally:
+        if filepath and not queued and os.path.exists(filepath):
+            os.remove(filepath)
+
 
 @app.route('/', methods=['GET'])
 def hello_world():
     return "Welcome to our pothole detector"
 
 
+def encode_potholes_json(batches):
+    yield "["
+    first = True
+    for rows in batches:
+        chunk = ",".join(
+            json.dumps({
+                "id": row[0],
+                "longitude": row[1],
+                "latitude": row[2],
+                "severity": row[3],
+                "timestamp": row[4].isoformat() if row[4] else None  # Convert timestamp to string
+            }, default=str)
+            for row in rows
+        )
+        yield chunk if first else "," + chunk
+        first = False
+    yield "]"
+
+
+def encode_potholes_columnar(batches):
+    for rows in batches:
+        yield json.dumps({
+            "id": [row[0] for row in rows],
+            "longitude": [float(row[1]) for row in rows],
+            "latitude": [float(row[2]) for row in rows],
+            "severity": [row[3] for row in rows],
+            "timestamp": [row[4].timestamp() if row[4] else None for row in rows],
+        }) + "\n"
+
+
+def encode_potholes_packed(batches):
+    for rows in batches:
+        yield b"".join(
+            POTHOLE_RECORD.pack(row[0], row[1], row[2], row[3] or 0, row[4].timestamp() if row[4] else float("nan"))
+            for row in rows
+        )
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 @app.route('/potholes', methods=['GET'])
 def get_potholes():
-    """Fetch all potholes from the database"""
+    """Stream all potholes from the database.
+
+    The encoding is picked from ?format= or the Accept header: a JSON array of
+    objects (default), columnar JSON batches, or packed binary records.
+    """
     print("Vili vann", flush=True)
+    requested = request.args.get("format")
+    if requested:
+        mimetype = POTHOLE_FORMATS.get(requested)
+        if mimetype is None:
+            return jsonify({"error": f"Unknown format '{requested}'"}), 400
+    else:
+        mimetype = request.accept_mimetypes.best_match([POTHOLE_JSON, POTHOLE_COLUMNAR, POTHOLE_PACKED], POTHOLE_JSON)
+
+    conn = None
+    try:
+        conn = psycopg2.connect(**db_config)
+        # Named cursor keeps the result set on the server; rows arrive in batches
+        cursor = conn.cursor(name="potholes_export")
+        cursor.execute("SELECT id, longitude, latitude, severity, timestamp FROM potholes;")
+    except Exception as e:
+        if conn:
+            conn.close()
+        return jsonify({"error": str(e)}), 500
+
+    def batches():
+        while True:
+            rows = cursor.fetchmany(POTHOLE_EXPORT_BATCH)
+            if not rows:
+                break
+            yield rows
+
+    def close_cursor():
+        cursor.close()
+        conn.close()
+
+    if mimetype == POTHOLE_COLUMNAR:
+        body = encode_potholes_columnar(batches())
+    elif mimetype == POTHOLE_PACKED:
+        body = encode_potholes_packed(batches())
+    else:
+        body = encode_potholes_json(batches())
+
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if mimetype == POTHOLE_PACKED:
+        headers["X-Record-Format"] = POTHOLE_RECORD.format
+    if "gzip" in request.accept_encodings:
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+
+    response = Response(body, mimetype=mimetype, headers=headers)
+    # Runs once the body is sent or the client goes away, even if streaming never started
+    response.call_on_close(close_cursor)
+    return response
+
+SUMMARY_COLUMNS = "observation_count, severity_sum, max_severity, last_severity, recent_severity, first_seen, last_seen"
+
+
+def summary_to_dict(row):
+    """Convert the SUMMARY_COLUMNS part of a row to JSON; trend > 0 means recent detections are worse than average."""
+    count, severity_sum, max_severity, last_severity, recent_severity, first_seen, last_seen = row
+    mean_severity = severity_sum / count
+    return {
+        "count": count,
+        "mean_severity": mean_severity,
+        "max_severity": max_severity,
+        "last_severity": last_severity,
+        "trend": recent_severity - mean_severity,
+        "first_seen": first_seen.isoformat(),
+        "last_seen": last_seen.isoformat(),
+    }
+
+
+CELL_COLUMNS = "open_potholes, repair_count, last_repaired_at"
+
+
+def cell_to_dict(row):
+    """Convert the CELL_COLUMNS part of a row to JSON."""
+    open_potholes, repair_count, last_repaired_at = row
+    return {
+        "open_potholes": open_potholes,
+        "repair_count": repair_count,
+        "last_repaired_at": last_repaired_at.isoformat() if last_repaired_at else None,
+    }
+
+
+def query_summaries(query, params):
+    if not ensure_history_schema():
+        raise RuntimeError("History tables are not available")
+    conn = None
     try:
         conn = psycopg2.connect(**db_config)
         cursor = conn.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchall()
 
-        cursor.execute("SELECT id, longitude, latitude, severity, timestamp FROM potholes;")
-        data = cursor.fetchall()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
 
-        # Convert data into JSON format
-        potholes = [
-            {
-                "id": row[0],
-                "longitude": row[1],
-                "latitude": row[2],
-                "severity": row[3],
-                "timestamp": row[4].isoformat()  # Convert timestamp to string
-            }
-            for row in data
-        ]
 
-        return jsonify(potholes)
+@app.route('/summaries/pothole', methods=['GET'])
+def get_pothole_summary():
+    """Severity summary for the pothole at ?latitude=&longitude="""
+    latitude = request.args.get("latitude", type=float)
+    longitude = request.args.get("longitude", type=float)
+    if latitude is None or longitude is None:
+        return jsonify({"error": "latitude and longitude are required"}), 400
 
+    try:
+        rows = query_summaries(f'''SELECT repaired_at, {SUMMARY_COLUMNS} FROM pothole_summaries WHERE latitude = %s AND longitude = %s''',
+                               (latitude, longitude))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-    finally:
-        cursor.close()
-        conn.close()
+    if not rows:
+        return jsonify({"error": "No observations for this location"}), 404
+    repaired_at = rows[0][0]
+    return jsonify({"latitude": latitude, "longitude": longitude,
+                    "repaired_at": repaired_at.isoformat() if repaired_at else None, **summary_to_dict(rows[0][1:])})
+
+
+@app.route('/summaries/cell', methods=['GET'])
+def get_cell_summary():
+    """Severity summary for the grid cell containing ?latitude=&longitude="""
+    latitude = request.args.get("latitude", type=float)
+    longitude = request.args.get("longitude", type=float)
+    if latitude is None or longitude is None:
+        return jsonify({"error": "latitude and longitude are required"}), 400
+
+    cell_lat, cell_lon = grid_cell(latitude, longitude)
+    try:
+        rows = query_summaries(f'''SELECT {CELL_COLUMNS}, {SUMMARY_COLUMNS} FROM grid_cell_summaries WHERE cell_lat = %s AND cell_lon = %s''',
+                               (cell_lat, cell_lon))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    if not rows:
+        return jsonify({"error": "No observations in this cell"}), 404
+    return jsonify({"cell_latitude": cell_lat * GRID_CELL_SIZE, "cell_longitude": cell_lon * GRID_CELL_SIZE,
+                    "cell_size": GRID_CELL_SIZE, **cell_to_dict(rows[0][:3]), **summary_to_dict(rows[0][3:])})
+
+
+@app.route('/summaries/cells', methods=['GET'])
+def get_cell_summaries():
+    """Severity summaries for all grid cells in the ?min_lat=&min_lon=&max_lat=&max_lon= box"""
+    bounds = [request.args.get(name, type=float) for name in ("min_lat", "min_lon", "max_lat", "max_lon")]
+    if None in bounds:
+        return jsonify({"error": "min_lat, min_lon, max_lat and max_lon are required"}), 400
+
+    min_cell_lat, min_cell_lon = grid_cell(bounds[0], bounds[1])
+    max_cell_lat, max_cell_lon = grid_cell(bounds[2], bounds[3])
+    try:
+        rows = query_summaries(f'''SELECT cell_lat, cell_lon, {CELL_COLUMNS}, {SUMMARY_COLUMNS} FROM grid_cell_summaries
+                                   WHERE cell_lat BETWEEN %s AND %s AND cell_lon BETWEEN %s AND %s''',
+                               (min_cell_lat, max_cell_lat, min_cell_lon, max_cell_lon))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify([
+        {"cell_latitude": row[0] * GRID_CELL_SIZE, "cell_longitude": row[1] * GRID_CELL_SIZE,
+         "cell_size": GRID_CELL_SIZE, **cell_to_dict(row[2:5]), **summary_to_dict(row[5:])}
+        for row in rows
+    ])
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=7860, debug=False)
\ No newline at end of file